@@ -1,9 +1,19 @@
 import os
+import json
+import queue
+import tempfile
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
+import random
+import threading
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 from pprint import pprint
 from datetime import datetime
+from pymongo.errors import BulkWriteError, ConnectionFailure
 from dbConnection import db
 from dotenv import set_key, find_dotenv
 from dotenv import load_dotenv
@@ -18,30 +28,224 @@ HH_RU_CLIENT_ID = os.getenv('HH_RU_CLIENT_ID')
 HH_RU_CLIENT_SECRET = os.getenv('HH_RU_CLIENT_SECRET')
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 
+# Resolved once; refreshed tokens are written back here off the scraping threads
+DOTENV_PATH = find_dotenv()
+_DOTENV_WRITER = ThreadPoolExecutor(max_workers=1)
+
+def _save_access_token(token):
+    try:
+        set_key(DOTENV_PATH, 'HH_RU_ACCESS_TOKEN', token)
+        logging.info(".env updated with the new access token.")
+    except Exception as e:
+        logging.error(f"Failed to update .env with the new access token: {e}")
+
 vyachik_id = 1403125548
 
+def _retrying_adapter(allowed_methods=('GET', 'POST')):
+    """
+    HTTPAdapter that retries transient server errors inside urllib3,
+    with a pool sized for the worker threads sharing the session.
+    Retries happen inside a single session call: for HH requests they hold the IN_FLIGHT slot
+    and bypass RATE_LIMITER, so the budget is kept small (about 3 s of backoff in total).
+    Retry-After is ignored here so a 503 can't park a slot for as long as the server asks;
+    server-requested waits (429) are handled by ApiHhRu._get.
+    """
+    retry = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[500, 502, 503, 504],
+        allowed_methods=list(allowed_methods),
+        respect_retry_after_header=False,
+    )
+    return HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry)
+
+# Shared session so Telegram notifications reuse one keep-alive connection
+_TG_SESSION = requests.Session()
+_TG_SESSION.mount('https://', _retrying_adapter())
+
 def bot_send_message(message, chat_id=vyachik_id, bot_token=TELEGRAM_TOKEN):
     url = f'https://api.telegram.org/bot{bot_token}/sendMessage'
     params = {
         'chat_id': chat_id,
         'text': message
     }
-    response = requests.post(url, data=params)
-    return response.json()
+    response = _TG_SESSION.post(url, data=params, timeout=10)
+    return orjson.loads(response.content)
+
+class _TelegramBatcher:
+    """
+    Collects progress messages and posts them to Telegram from a background thread,
+    joined into one message every `interval` seconds or once the buffer nears Telegram's size limit.
+    """
+
+    def __init__(self, interval=10, max_chars=3500):
+        self.interval = interval
+        self.max_chars = max_chars
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def enqueue(self, message):
+        """Queues a message without blocking the caller on network I/O."""
+        self._queue.put(message)
+
+    def flush(self, timeout=30):
+        """
+        Sends everything queued so far without waiting for the interval.
+        Blocks for at most `timeout` seconds; returns False if the messages weren't delivered in time.
+        """
+        done = threading.Event()
+        self._queue.put(done)
+        if not done.wait(timeout):
+            logging.warning("Timed out waiting for Telegram messages to be sent.")
+            return False
+        return True
+
+    def _run(self):
+        buffer, size, deadline = [], 0, None
+        while True:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                message = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                message = None
+
+            if isinstance(message, threading.Event):  # Flush request
+                if buffer:
+                    self._send(buffer)
+                    buffer, size, deadline = [], 0, None
+                message.set()
+                continue
+
+            if message is not None:
+                if buffer and size + len(message) + 1 > self.max_chars:
+                    self._send(buffer)
+                    buffer, size = [], 0
+                buffer.append(message)
+                size += len(message) + 1
+                if deadline is None:
+                    deadline = time.monotonic() + self.interval
+
+            if buffer and time.monotonic() >= deadline:
+                self._send(buffer)
+                buffer, size, deadline = [], 0, None
+
+    def _send(self, messages):
+        try:
+            bot_send_message('\n'.join(messages))
+        except Exception as e:  # Never let a failed notification kill the sender thread
+            logging.error(f"Failed to send Telegram message: {e}")
+
+telegram = _TelegramBatcher()
+
+# Reference data (countries, professional roles) changes rarely, so it is cached on disk between runs
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.hhcache')
+
+def _cached(name, ttl_days, fn):
+    """Returns the cached JSON for `name` if younger than `ttl_days`, otherwise calls `fn` and caches its result."""
+    path = os.path.join(CACHE_DIR, f'{name}.json')
+    try:
+        if time.time() - os.path.getmtime(path) < ttl_days * 86400:
+            with open(path, encoding='utf-8') as f:
+                return json.load(f)
+    except (OSError, ValueError):
+        pass
+
+    data = fn()
+    if data:  # Don't cache failed fetches
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            # Write to a temp file and swap it in, so a concurrent run never reads a half-written cache
+            fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, prefix=f'{name}.', suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, ensure_ascii=False)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except OSError as e:
+            logging.warning(f"Failed to write {name} cache: {e}")
+    return data
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+class _AdaptiveRateLimiter:
+    """
+    Token bucket shared by all worker threads.
+    The rate is halved when HH answers 429 (at most once per `cooldown` seconds, so one burst of
+    429s across all threads counts as a single throttle) and grows back additively on every success.
+    """
+
+    def __init__(self, rate=8.0, min_rate=0.5, max_rate=16.0, increase=0.1, cooldown=1.0):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.cooldown = cooldown
+        self._tokens = rate
+        self._updated = time.monotonic()
+        self._throttled_at = None
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a request may be sent."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                # Burst capacity never drops below one token, otherwise a rate under 1/s could never be served
+                self._tokens = min(max(1.0, self.rate), self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_throttle(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._throttled_at is not None and now - self._throttled_at < self.cooldown:
+                return
+            self._throttled_at = now
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = 0
+
+
 class ApiHhRu:
     BASE_URL = 'https://api.hh.ru'
     COUNTRY = 'Россия'
     ACCESS_TOKEN = None
     AREAS = None
+    # Shared pool for fetching the remaining pages of a search; kept below HH's rate limit
+    PAGE_EXECUTOR = ThreadPoolExecutor(max_workers=8)
+    # Pages of one search fetched ahead of the consumer; bounds how many pages sit in memory
+    PAGE_WINDOW = 3
+    # Number of (area, role) pairs processed concurrently; a separate pool so pair workers never wait on themselves
+    PAIR_WORKERS = 8
+    # Client-side limiter shared by every thread talking to api.hh.ru
+    RATE_LIMITER = _AdaptiveRateLimiter()
+    # Caps requests in flight across all pools, however many threads call _get
+    IN_FLIGHT = threading.BoundedSemaphore(8)
+    # Upper bound on rate-limited attempts per request so a throttled page doesn't stall the pipeline
+    MAX_ATTEMPTS = 4
 
     def __init__(self, areas, token=HH_RU_ACCESS_TOKEN):
         self.ACCESS_TOKEN = token
-        self.headers = {'Authorization': f'Bearer {self.ACCESS_TOKEN}'}
-        self.AREAS = areas
+        self.AREAS = frozenset(areas)
+
+        # One session per client so paginated calls to api.hh.ru reuse the TCP/TLS connection
+        self.session = requests.Session()
+        self.session.headers.update({'Authorization': f'Bearer {self.ACCESS_TOKEN}'})
+        # GET only: the OAuth refresh POST must not be retried, HH refresh tokens are single-use
+        self.session.mount('https://', _retrying_adapter(allowed_methods=('GET',)))
+        # Serializes token refreshes when several page requests hit 401 at once
+        self._refresh_lock = threading.Lock()
 
     def refresh_access_token(self):
         """
@@ -55,49 +259,81 @@ class ApiHhRu:
             'client_secret': HH_RU_CLIENT_SECRET,
         }
         try:
-            response = requests.post(url, data=data)
+            # Drop the stale bearer header: the OAuth endpoint authenticates by client credentials
+            response = self.session.post(url, data=data, headers={'Authorization': None}, timeout=30)
             response.raise_for_status()
-            tokens = response.json()
+            tokens = orjson.loads(response.content)
             new_access_token = tokens.get('access_token')
             if new_access_token:
                 self.ACCESS_TOKEN = new_access_token
-                self.headers['Authorization'] = f'Bearer {self.ACCESS_TOKEN}'
-                
-                # Update the .env file with the new access token
-                dotenv_path = find_dotenv()
-                set_key(dotenv_path, 'HH_RU_ACCESS_TOKEN', new_access_token)
+                self.session.headers['Authorization'] = f'Bearer {self.ACCESS_TOKEN}'
                 
-                logging.info("Access token refreshed and .env updated successfully.")
+                # Update the .env file with the new access token in the background
+                _DOTENV_WRITER.submit(_save_access_token, new_access_token)
+
+                logging.info("Access token refreshed successfully.")
                 return True
             else:
                 logging.error("No new access token found in the response.")
                 return False
-        except requests.exceptions.RequestException as e:
+        except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
             logging.error(f"Failed to refresh access token: {e}")
             return False
 
     def _get(self, url, params=None):
         """
-        Helper method for GET requests with token refresh logic.
+        Helper method for GET requests with token refresh and retry logic.
         If a 401 Unauthorized error occurs, the method attempts to refresh the access token and retries the request.
+        On 429 the shared rate limiter backs off (honoring Retry-After); 5xx responses are retried by the session adapter.
         """
+        refreshed = False
+        for attempt in range(self.MAX_ATTEMPTS):
+            try:
+                self.RATE_LIMITER.acquire()
+                sent_token = self.ACCESS_TOKEN
+                with self.IN_FLIGHT:
+                    response = self.session.get(url, params=params, timeout=30)
+
+                if response.status_code == 401 and not refreshed:  # Unauthorized, possibly token expired
+                    refreshed = True
+                    with self._refresh_lock:
+                        # Another thread may have already refreshed the token while we waited
+                        if self.ACCESS_TOKEN == sent_token:
+                            logging.info("Access token expired. Attempting to refresh token.")
+                            if not self.refresh_access_token():
+                                return None
+                    continue
+
+                if response.status_code == 429:
+                    self.RATE_LIMITER.on_throttle()
+                    if attempt < self.MAX_ATTEMPTS - 1:
+                        delay = self._retry_delay(response, attempt)
+                        logging.warning(f"Got {response.status_code} from {url}, retrying in {delay:.1f}s")
+                        time.sleep(delay)
+                        continue
+
+                response.raise_for_status()
+                self.RATE_LIMITER.on_success()
+                return orjson.loads(response.content)
+            except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
+                logging.error(f"Request failed: {e}")
+                return None
+
+        logging.error(f"Giving up on {url} after {self.MAX_ATTEMPTS} attempts")
+        return None
+
+    @staticmethod
+    def _retry_delay(response, attempt):
+        """Returns the backoff before the next attempt, preferring the server's Retry-After."""
         try:
-            response = requests.get(url, headers=self.headers, params=params)
-            if response.status_code == 401:  # Unauthorized, possibly token expired
-                logging.info("Access token expired. Attempting to refresh token.")
-                if self.refresh_access_token():
-                    response = requests.get(url, headers=self.headers, params=params)
-                else:
-                    return None
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            logging.error(f"Request failed: {e}")
-            return None
+            delay = float(response.headers['Retry-After'])
+        except (KeyError, ValueError):
+            delay = 2 ** attempt
+        return delay + random.uniform(0, 0.5)
 
     def fetch_countries(self):
         """Fetches the list of countries."""
-        return self._get(f'{self.BASE_URL}/areas/countries') or []
+        return _cached('countries', 7, lambda: self._get(f'{self.BASE_URL}/areas/countries')) or []
 
     def find_country_url(self, country_name):
         """Finds the country URL by name."""
@@ -119,7 +355,7 @@ class ApiHhRu:
     def fetch_professional_roles(self):
         """Fetches the list of professional roles."""
         url = f'{self.BASE_URL}/professional_roles'
-        roles = self._get(url)
+        roles = _cached('professional_roles', 7, lambda: self._get(url))
         return roles.get('categories', []) if roles else []
 
     def get_vacancies(self, area_id, professional_role_id, page=0):
@@ -135,44 +371,78 @@ class ApiHhRu:
         }
         return self._get(f'{self.BASE_URL}/vacancies', params)
 
-    def fetch_all_vacancies(self, area_id, professional_role_id):
-        """Fetches all vacancies for a given area and professional role."""
-        vacancies, page, total_pages = [], 0, 1
-
-        while page < total_pages:
-            logging.info(f"Fetching page {page} for area {area_id} and role {professional_role_id}")
-            data = self.get_vacancies(area_id, professional_role_id, page)
-
-            if not data or 'items' not in data:
-                logging.warning("No vacancies found or invalid data.")
-                break
-
-            vacancies.extend(data['items'])
-            total_pages = data.get('pages', 1)
-            page += 1
+    def iter_vacancy_pages(self, area_id, professional_role_id):
+        """
+        Yields the vacancies of each page for a given area and professional role.
+        The first page is fetched serially to learn the page count, the rest in parallel and yielded as they complete.
+        At most PAGE_WINDOW pages are in flight or waiting for the consumer at any time.
+        """
+        logging.info(f"Fetching page 0 for area {area_id} and role {professional_role_id}")
+        data = self.get_vacancies(area_id, professional_role_id, 0)
 
-        return vacancies
+        if not data or 'items' not in data:
+            logging.warning("No vacancies found or invalid data.")
+            return
 
-    def save_vacancies_to_db(self, vacancies, area_name):
-        """Saves vacancies to the database, avoiding duplicates."""
-        inserted, duplicates = 0, 0
+        yield data['items']
+        total_pages = data.get('pages', 1)
+        if total_pages > 1:
+            logging.info(f"Fetching pages 1-{total_pages - 1} for area {area_id} and role {professional_role_id}")
+
+        pages = iter(range(1, total_pages))
+        futures = {}
+
+        def submit_next():
+            page = next(pages, None)
+            if page is not None:
+                futures[self.PAGE_EXECUTOR.submit(self.get_vacancies, area_id, professional_role_id, page)] = page
+
+        for _ in range(self.PAGE_WINDOW):
+            submit_next()
+
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                # Drop the finished future so its page is freed once the consumer is done with it
+                page = futures.pop(future)
+                data = future.result()
+                if not data or 'items' not in data:
+                    logging.warning(f"No vacancies found or invalid data on page {page}.")
+                else:
+                    yield data['items']
+                # Refill the window only once the consumer has finished with this page
+                submit_next()
 
-        for vacancy in vacancies:
-            vacancy['entry_date'] = datetime.utcnow().strftime('%d.%m.%Y')
-            vacancy['area_name'] = area_name
+    def save_vacancies_to_db(self, vacancies, area_name, entry_date=None):
+        """
+        Saves vacancies to the database in one batch, avoiding duplicates.
+        `entry_date` defaults to today (UTC); callers saving many batches compute it once and pass it in.
+        Returns the number of inserted and duplicate vacancies.
+        """
+        today = entry_date or datetime.utcnow().strftime('%d.%m.%Y')
+        ids = [vacancy['id'] for vacancy in vacancies]
 
-            if db.find_one({"id": vacancy['id'], "entry_date": vacancy['entry_date']}):
-                duplicates += 1
-                continue
+        # One round-trip to find which vacancies were already stored today; projecting only `id`
+        # (without `_id`) lets the (id, entry_date) index cover the query without fetching documents
+        existing = set(doc['id'] for doc in db.find({"id": {"$in": ids}, "entry_date": today}, {"id": 1, "_id": 0}))
+        new_docs = [dict(vacancy, entry_date=today, area_name=area_name) for vacancy in vacancies if vacancy['id'] not in existing]
+        duplicates = len(vacancies) - len(new_docs)
 
+        inserted = 0
+        if new_docs:
             try:
-                db.insert_one(vacancy)
-                inserted += 1
-            except Exception as e:
-                logging.error(f"Error saving vacancy {vacancy['url']}: {e}")
-
-        bot_send_message(f"Inserted: {inserted}, Duplicates: {duplicates}")
-        logging.info(f"Inserted: {inserted}, Duplicates: {duplicates}")
+                inserted = len(db.insert_many(new_docs, ordered=False).inserted_ids)
+            except BulkWriteError as e:
+                inserted = e.details.get('nInserted', 0)
+                for error in e.details.get('writeErrors', []):
+                    if error.get('code') == 11000:
+                        # Inserted concurrently since the lookup above, or repeated within the batch
+                        duplicates += 1
+                    else:
+                        vacancy = new_docs[error['index']]
+                        logging.error(f"Error saving vacancy {vacancy.get('url')}: {error.get('errmsg')}")
+
+        return inserted, duplicates
 
     def fetch_and_store_vacancies(self):
         """Fetches and stores vacancies for all areas and roles."""
@@ -186,28 +456,55 @@ class ApiHhRu:
             logging.error("No professional roles found.")
             return
 
-        # Initialize a set to store unique role IDs
+        # One entry date for the whole run, so batches saved after midnight UTC stay in the same snapshot
+        entry_date = datetime.utcnow().strftime('%d.%m.%Y')
+
+        # Flatten categories into a single list of roles, keeping the first occurrence of each role ID
         unique_role_ids = set()
-        filtered_roles = []
+        roles = []
 
         for category in professional_roles:
-            unique_roles_in_category = []
             for role in category['roles']:
-                role_id = role['id']
-                if role_id not in unique_role_ids:
-                    unique_role_ids.add(role_id)
-                    unique_roles_in_category.append(role)
-            if unique_roles_in_category:
-                filtered_roles.append({'roles': unique_roles_in_category})
-
-        for area in areas:
-            bot_send_message(message=f"Processing area {area['name']} (ID: {area['id']})")
-            logging.info(f"Processing area {area['name']} (ID: {area['id']})")
-            for category in filtered_roles:
-                for role in category['roles']:
-                    bot_send_message(message=f"Fetching vacancies for role {role['name']} (ID: {role['id']})")
-                    logging.info(f"Fetching vacancies for role {role['name']} (ID: {role['id']})")
-                    vacancies = self.fetch_all_vacancies(area['id'], role['id'])
-                    self.save_vacancies_to_db(vacancies, area['name'])
+                if role['id'] not in unique_role_ids:
+                    unique_role_ids.add(role['id'])
+                    roles.append(role)
 
+        # Flat list of (area, role) work items so slow pairs overlap with fast ones
+        pairs = [(area, role) for area in areas for role in roles]
+        telegram.enqueue(f"Processing {len(areas)} areas, {len(pairs)} area/role pairs")
+        logging.info(f"Processing {len(areas)} areas, {len(pairs)} area/role pairs")
 
+        try:
+            with ThreadPoolExecutor(max_workers=self.PAIR_WORKERS) as executor:
+                futures = {
+                    executor.submit(self._fetch_and_store_pair, area, role, entry_date): (area, role)
+                    for area, role in pairs
+                }
+                for future in as_completed(futures):
+                    area, role = futures[future]
+                    try:
+                        future.result()
+                    except ConnectionFailure:
+                        # MongoDB is unreachable: every remaining pair would fail the same way
+                        logging.critical(f"Lost connection to MongoDB while processing role {role['name']} (ID: {role['id']}) in area {area['name']} (ID: {area['id']}), aborting run")
+                        executor.shutdown(wait=False, cancel_futures=True)
+                        raise
+                    except Exception as e:
+                        logging.error(f"Failed to process role {role['name']} (ID: {role['id']}) in area {area['name']} (ID: {area['id']}): {e}")
+        finally:
+            # Deliver the last batch of progress messages before the run ends
+            telegram.flush()
+
+    def _fetch_and_store_pair(self, area, role, entry_date):
+        """Fetches and stores vacancies for a single area and role."""
+        telegram.enqueue(f"Fetching vacancies for role {role['name']} (ID: {role['id']}) in area {area['name']} (ID: {area['id']})")
+        logging.info(f"Fetching vacancies for role {role['name']} (ID: {role['id']}) in area {area['name']} (ID: {area['id']})")
+        # Flush each page as it arrives so only the pages in the fetch window are held in memory
+        inserted, duplicates = 0, 0
+        for page_items in self.iter_vacancy_pages(area['id'], role['id']):
+            page_inserted, page_duplicates = self.save_vacancies_to_db(page_items, area['name'], entry_date)
+            inserted += page_inserted
+            duplicates += page_duplicates
+
+        telegram.enqueue(f"Inserted: {inserted}, Duplicates: {duplicates}")
+        logging.info(f"Inserted: {inserted}, Duplicates: {duplicates}")
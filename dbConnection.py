@@ -1,7 +1,24 @@
+import logging
+
 from pymongo import MongoClient
+from pymongo.errors import DuplicateKeyError
 
 client = MongoClient("localhost", 27017)
 
 db = client.job_forecast.hh_ru_jobs
 
+# Module logger, so an error here doesn't configure the root logger before api.py does
+logger = logging.getLogger(__name__)
 
+# Compound unique index backing the (id, entry_date) dedupe lookup in ApiHhRu.save_vacancies_to_db.
+# Duplicate inserts raise DuplicateKeyError and are skipped by the unordered insert_many.
+try:
+    db.create_index([('id', 1), ('entry_date', 1)], unique=True, background=True)
+except DuplicateKeyError as e:
+    # Older runs could store the same vacancy twice on one day; the index can't be built until
+    # those rows are removed (keep one document per (id, entry_date) pair and delete the rest).
+    # Until then scraping still works, only without the index and its duplicate protection.
+    logger.error(
+        "Could not create unique index on (id, entry_date) in job_forecast.hh_ru_jobs: "
+        f"the collection already contains duplicate rows. Remove them and rerun. Details: {e}"
+    )